@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+# Written in 2012 by Joe Tsai <joetsai@digital-static.net>
+#
+# ===================================================================
+# The contents of this file are dedicated to the public domain. To
+# the extent that dedication to the public domain is not available,
+# everyone is granted a worldwide, perpetual, royalty-free,
+# non-exclusive license to exercise all rights associated with the
+# contents of this file for any purpose whatsoever.
+# No rights are reserved.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ===================================================================
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import socket
+import optparse
+import resource
+import tempfile
+import threading
+import collections
+
+
+################################################################################
+############################### Global variables ###############################
+################################################################################
+
+# Linux terminal colors
+LGRAY1  = '\x1b[1;37m'
+DGRAY1  = '\x1b[1;30m'
+BLUE1   = '\x1b[1;34m'
+BLUE0   = '\x1b[0;34m'
+YELLOW1 = '\x1b[1;33m'
+RESET   = '\x1b[0m'
+
+# Color aliases
+NUM_PRIMARY    = BLUE1
+NUM_SECONDARY  = BLUE0
+TEXT_PRIMARY   = LGRAY1
+TEXT_SECONDARY = DGRAY1
+WARNING        = YELLOW1
+
+# Warning settings and thresholds
+CPU_UTIL_WARN_LEVEL = 80.0      # CPU utilization in percents
+NET_WARN_LEVEL      = 1048576.0 # Network usage in B/s
+
+# Miscellaneous settings and configurations
+HOSTS_FILE = '/usr/local/motd_gen/fleet_hosts' # Nodes as host[:port] per line
+STAT_PORT = 4004 # Default port for the motd_stat daemons
+TIMEOUT = 2.0 # Seconds to wait for a node before it is unreachable
+RESOLVERS = 16 # Host names to resolve at once
+CACHE_TTL = 30 # Seconds to reuse the results of a previous run
+CACHE_DIR = None # Directory to cache in (None for the user's runtime or cache)
+MAX_NAMED = 5 # Nodes to name before summarizing the rest
+NETTRAF_DEVICE = 'eth0' # The network device to monitor
+NETTRAF_INTERVAL = 600 # Time length in seconds to average the bandwidth over
+NETTRAF_WEIGHT = 1.0 # Perform linear moving average weight
+CPUUTIL_DEVICE = 'all' # Get the aggregate CPU utilization
+CPUUTIL_INTERVAL = 300 # Time length in seconds to average the utilization over
+CPUUTIL_WEIGHT = 0.0 # Straight average for CPU utilizaiton
+
+# Queries sent to every node
+QUERIES = {
+    'cpu_util': {
+        'device':   CPUUTIL_DEVICE,
+        'interval': CPUUTIL_INTERVAL,
+        'weight':   CPUUTIL_WEIGHT,
+    },
+    'net_traf': {
+        'device':   NETTRAF_DEVICE,
+        'interval': NETTRAF_INTERVAL,
+        'weight':   NETTRAF_WEIGHT,
+    },
+}
+
+opts,args = None, None
+info_list = []
+
+
+################################################################################
+############################### Helper functions ###############################
+################################################################################
+
+def colorize(text, color):
+    """Colorize the text only if color is enabled"""
+    global opts
+    return color + unicode(text) + RESET if opts.color else text
+
+
+def iec_unitize(value, units = '', width = 4, color = NUM_SECONDARY):
+    """Apply prefix using the IEC standard"""
+    prefixes = ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi']
+    for prefix in prefixes:
+        if round(value) < 1024:
+            text = ('%0.' + str(width-2) + 'f') % value
+            text = text[:width]
+            if text[-1] == '.':
+                text = text[:-1]
+            return colorize(text + ' ' + prefix + units, color)
+        value = value / 1024.0
+    raise ValueError("Unable to convert value to human readable format")
+
+
+def parse_endpoint(endpoint):
+    """Split a host[:port] string into an address tuple"""
+    host, _, port = endpoint.strip().partition(':')
+    return host, int(port or STAT_PORT)
+
+
+def read_endpoints(path):
+    """Read the list of nodes, ignoring blank lines and comments"""
+    endpoints = []
+    with open(path, 'r') as hosts_file:
+        for line in hosts_file.readlines():
+            line = line.split('#', 1)[0].strip()
+            if line:
+                endpoints.append(line)
+    return endpoints
+
+
+def resolve(addresses, deadline):
+    """Resolve (host, port) addresses in parallel until the deadline"""
+    results = dict()
+    queue = collections.deque(addresses)
+    def resolver():
+        while True:
+            try:
+                address = queue.popleft()
+            except IndexError:
+                return
+            try:
+                results[address] = socket.getaddrinfo(
+                    address[0], address[1], 0, socket.SOCK_STREAM)[0]
+            except socket.error:
+                pass
+
+    # Threads are daemonic so that a hung lookup cannot block the exit
+    threads = []
+    for index in xrange(min(RESOLVERS, len(queue))):
+        thread = threading.Thread(target = resolver)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+    return dict(results)
+
+
+def fan_out(requests, timeout):
+    """Send (key, address, query) requests concurrently and gather replies"""
+    # Replies that fail or do not arrive before the timeout are None
+    results = dict((key, None) for key, address, query in requests)
+    deadline = time.time() + timeout
+    addresses = resolve(set(x[1] for x in requests), deadline)
+    queued = collections.deque(
+        (key, addresses[address], query)
+        for key, address, query in requests if addresses.has_key(address))
+
+    # Leave some file descriptors for everything else
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if limit == resource.RLIM_INFINITY:
+        limit = 65536
+    limit = max(limit - 64, 1)
+
+    poller = select.poll()
+    pending = dict()
+    while queued or pending:
+        # Connect to more nodes while descriptors are available
+        while queued and len(pending) < limit:
+            key, address, query = queued.popleft()
+            family, socktype, proto, _, sockaddr = address
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(0)
+                error = sock.connect_ex(sockaddr)
+                if error not in (0, errno.EINPROGRESS):
+                    sock.close()
+                    continue
+            except socket.error:
+                continue
+            pending[sock.fileno()] = [sock, key, json.dumps(query), '']
+            poller.register(sock, select.POLLOUT)
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+
+        for fd, event in poller.poll(remaining * 1000):
+            state = pending[fd]
+            sock, key = state[0], state[1]
+            try:
+                if state[2]:
+                    # Wait for the reply once the query is sent
+                    state[2] = state[2][sock.send(state[2]):]
+                    if not state[2]:
+                        poller.modify(fd, select.POLLIN)
+                    continue
+                data = sock.recv(4096)
+                if data:
+                    state[3] += data
+                    continue
+
+                # The daemon closes the connection after its reply
+                reply = json.loads(state[3])
+                if isinstance(reply, dict) and not reply.has_key('error'):
+                    results[key] = reply
+            except (socket.error, ValueError):
+                pass
+            poller.unregister(fd)
+            sock.close()
+            del pending[fd]
+
+    for state in pending.values():
+        state[0].close()
+    return results
+
+
+def query_fleet(endpoints, timeout):
+    """Query every node and give the replies of each node by endpoint"""
+    requests = []
+    for endpoint in endpoints:
+        for name, kwargs in QUERIES.items():
+            key = (endpoint, name)
+            requests.append((key, parse_endpoint(endpoint), {name: kwargs}))
+    replies = fan_out(requests, timeout)
+
+    results = dict()
+    for endpoint in endpoints:
+        node = dict((x, replies[(endpoint, x)]) for x in QUERIES.keys())
+        results[endpoint] = node if any(node.values()) else None
+    return results
+
+
+def locate_cache():
+    """Get the path of the cache in a directory private to the user"""
+    directory = CACHE_DIR or os.environ.get('XDG_RUNTIME_DIR')
+    if not directory:
+        directory = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(directory, 'motd_fleet.json')
+
+
+def load_cache(path, endpoints):
+    """Load the results of a previous run if they are recent enough"""
+    try:
+        with open(path, 'r') as cache_file:
+            # Only trust results that the user saved
+            assert os.fstat(cache_file.fileno()).st_uid == os.getuid()
+            cache = json.load(cache_file)
+        assert cache['endpoints'] == endpoints
+        assert cache['queries'] == QUERIES
+        assert 0 <= time.time() - cache['time'] < opts.cache_ttl
+        return cache['results']
+    except:
+        return None
+
+
+def save_cache(path, endpoints, results):
+    """Save the results for later runs, replacing the cache atomically"""
+    cache = {
+        'time': time.time(),
+        'endpoints': endpoints,
+        'queries': QUERIES,
+        'results': results,
+    }
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        fd, temp_path = tempfile.mkstemp(prefix = 'motd_fleet.',
+                                         dir = directory)
+    except (IOError, OSError):
+        return
+    try:
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+
+
+def summarize(nodes, total, limit_text, color):
+    """Summarize the nodes over a warning level"""
+    count_text = colorize(len(nodes), color if nodes else NUM_PRIMARY)
+    message = "%s of %s nodes over %s" % (count_text, total, limit_text)
+    if nodes:
+        names = ['%s (%s)' % x for x in nodes[:MAX_NAMED]]
+        if len(nodes) > MAX_NAMED:
+            names.append('%s more' % (len(nodes) - MAX_NAMED))
+        message += ' - ' + ', '.join(names)
+    return message
+
+
+def display_info():
+    """Display fleet statistical information"""
+    global info_list
+    max_length = max([len(key) for key, value in info_list])
+    for key, value in info_list:
+        key = (key + ':').ljust(max_length + 4, ' ')
+        print " %s%s" % (colorize(key, TEXT_SECONDARY), value)
+
+
+################################################################################
+################################ Options parser ################################
+################################################################################
+
+epilog = """\
+This is a fleet summary companion to the MOTD generator. It queries the
+motd_stat daemons of many nodes concurrently and reports how many of them
+exceed the CPU utilization and network traffic thresholds. Nodes are given as
+host[:port] entries, either on the command line or one per line in a hosts
+file. Results are cached briefly so that a burst of logins on a jump host
+does not query the whole fleet each time.
+
+Author: Joe Tsai <joetsai@digital-static.net>
+"""
+
+# Create a config parser
+opts_parser = optparse.OptionParser(
+    usage = "%prog [options] [host[:port] ...]", add_help_option = False)
+opts_parser.format_epilog = lambda x: '\n' + epilog
+opts_parser.add_option(
+    '-h', '--help', action = 'help',
+    help = "Display this help and exit.",
+)
+opts_parser.add_option(
+    '-c', '--color', default = False, action = "store_true",
+    help = "Print the summary with color.",
+)
+opts_parser.add_option(
+    '-w', '--warn', default = False, action = "store_true",
+    help = (
+        "Highlight any potential issues. If this option is selected, it will "
+        "enable colored output."
+    ),
+)
+opts_parser.add_option(
+    '-f', '--hosts_file', default = None,
+    help = (
+        "File listing the nodes to query, one host[:port] per line. Used "
+        "when no nodes are given as arguments [%s]." % HOSTS_FILE
+    ),
+)
+opts_parser.add_option(
+    '-t', '--timeout', default = TIMEOUT, type = 'float',
+    help = "Seconds to wait for a node before it is unreachable [%default].",
+)
+opts_parser.add_option(
+    '-a', '--cache_ttl', default = CACHE_TTL, type = 'float',
+    help = "Seconds to reuse previous results, 0 to disable [%default].",
+)
+(opts, args) = opts_parser.parse_args()
+
+# Color is enabled if warning is enabled
+if opts.warn:
+    opts.color = True
+
+# Output is not a tty
+if not hasattr(sys.stderr, "isatty") or not sys.stderr.isatty():
+    opts.color = False
+
+if opts.timeout <= 0:
+    print "Timeout must be a positive value"
+    sys.exit(1)
+
+# Nodes on the command line take precedence over the hosts file
+try:
+    endpoints = args or read_endpoints(opts.hosts_file or HOSTS_FILE)
+except IOError, ex:
+    print "Unable to read hosts file: %s" % ex
+    sys.exit(1)
+if not endpoints:
+    print "No nodes to query"
+    sys.exit(1)
+
+
+################################################################################
+################################# Script start #################################
+################################################################################
+
+# Query the nodes unless a recent run already did
+cache_path = locate_cache()
+results = load_cache(cache_path, endpoints) if opts.cache_ttl > 0 else None
+if results is None:
+    results = query_fleet(endpoints, opts.timeout)
+    if opts.cache_ttl > 0:
+        save_cache(cache_path, endpoints, results)
+
+# Classify the nodes
+cpu_nodes, net_nodes, down_nodes = [], [], []
+for endpoint in endpoints:
+    node = results[endpoint]
+    if node is None:
+        down_nodes.append(endpoint)
+        continue
+
+    # A node may lack the queried network device
+    if node['cpu_util']:
+        util = node['cpu_util']['utilization'] * 100.0
+        if util > CPU_UTIL_WARN_LEVEL:
+            cpu_nodes.append((util, endpoint, '%.2f%%' % util))
+    if node['net_traf']:
+        traf = node['net_traf']
+        total = traf['rx_average'] + traf['tx_average']
+        if total > NET_WARN_LEVEL:
+            net_nodes.append((total, endpoint, iec_unitize(total, 'B/s')))
+
+# Worst nodes are listed first
+cpu_nodes = [(x[1], x[2]) for x in sorted(cpu_nodes, reverse = True)]
+net_nodes = [(x[1], x[2]) for x in sorted(net_nodes, reverse = True)]
+
+####################
+# Generate info list
+color = WARNING if opts.warn else NUM_PRIMARY
+up_count = len(endpoints) - len(down_nodes)
+values = colorize(up_count, NUM_PRIMARY), len(endpoints)
+info_list.append(('Fleet nodes', "%s of %s nodes responding" % values))
+
+limit_text = '%.2f%%' % CPU_UTIL_WARN_LEVEL
+message = summarize(cpu_nodes, up_count, limit_text, color)
+info_list.append(('CPU utilization', message))
+
+limit_text = iec_unitize(NET_WARN_LEVEL, 'B/s', color = NUM_PRIMARY)
+message = summarize(net_nodes, up_count, limit_text, color)
+info_list.append(('Network traffic', message))
+
+if down_nodes:
+    names = down_nodes[:MAX_NAMED]
+    if len(down_nodes) > MAX_NAMED:
+        names.append('%s more' % (len(down_nodes) - MAX_NAMED))
+    info_list.append(('Unreachable', colorize(', '.join(names), color)))
+
+####################
+# Display the summary
+display_info()
@@ -24,9 +24,11 @@ import re
 import os
 import sys
 import json
+import time
 import getpass
 import optparse
 import datetime
+import threading
 
 
 ################################################################################
@@ -79,6 +81,7 @@ REGEX_CTIME = (
     r'[a-zA-Z]{3} [a-zA-Z]{3} [ 0-9]{2} '  # Day name, month, day
     r'[0-9]{2}:[0-9]{2}:[0-9]{2} [0-9]{4}' # HH:MM:SS YYYY
 )
+REGEX_OCTAL = r'\\([0-7]{3})'
 
 # Warning settings and thresholds
 CPU_UTIL_WARN_LEVEL = 80.0      # CPU utilization in percents
@@ -86,6 +89,9 @@ CPU_LOAD_WARN_LEVEL = 0.8       # CPU normalized load (multiply number of cores)
 RAM_WARN_LEVEL      = 80.0      # RAM usage in percents
 DISK_WARN_LEVEL     = 80.0      # Disk usage in percents
 NET_WARN_LEVEL      = 1048576.0 # Network usage in B/s
+DISKIO_WARN_LEVEL   = 52428800.0 # Disk I/O throughput in B/s
+IO_UTIL_WARN_LEVEL  = 80.0      # Disk I/O utilization in percents
+PSI_WARN_LEVEL      = 10.0      # Time stalled on a resource in percents
 
 # Miscellaneous settings and configurations
 CACHE_FREE = True # Is disk cache considered free memory or not?
@@ -96,6 +102,23 @@ NETTRAF_INTERVAL = 600 # Time length in seconds to average the bandwidth over
 NETTRAF_WEIGHT = 1.0 # Perform linear moving average weight
 CPUUTIL_DEVICE = 'all' # Get the aggregate CPU utilization
 CPUUTIL_WEIGHT = 0.0 # Straight average for CPU utilizaiton
+CPUUTIL_PERCENTILE = 95 # Percentile of CPU utilization to show if enabled
+NETTRAF_PERCENTILE = 99 # Percentile of the bandwidth to show if enabled
+DISKIO_DEVICE = None # The block device to monitor (None for the root disk)
+DISKIO_INTERVAL = 600 # Time length in seconds to average the disk I/O over
+DISKIO_WEIGHT = 1.0 # Perform linear moving average weight
+PSI_RESOURCES = ['cpu', 'memory', 'io'] # Resources to report stalls for
+PSI_INTERVAL = 300 # Time length in seconds to average the stall time over
+PSI_WEIGHT = 0.0 # Straight average for stall time
+CGROUP_DEVICE = 'self' # The control group to report when confined
+CGROUP_INTERVAL = 300 # Time length in seconds to average cgroup usage over
+CGROUP_WEIGHT = 0.0 # Straight average for cgroup usage
+DISK_MOUNTS = None # Mount points to report (None for all real filesystems)
+DISK_TIMEOUT = 1.0 # Seconds to wait for a mount before it is unresponsive
+DISK_MOUNT_WIDTH = 16 # Longest mount point to show before shortening it
+DISK_NET_FSTYPES = ['nfs', 'nfs4', 'cifs', 'smb3', 'ceph', 'glusterfs']
+DISK_POOL_FSTYPES = ['zfs'] # Local file systems mounted from storage pools
+DISK_SKIP_FSTYPES = ['squashfs', 'iso9660', 'udf']
 
 opts,args = None, None
 utf_support = None
@@ -123,6 +146,90 @@ def shell_escape(data):
     return "'" + data.replace("'", "'\\''") + "'"
 
 
+def query_stat(query):
+    """Send a query to the motd_stat daemon and load the JSON reply"""
+    query = shell_escape(json.dumps(query))
+    command = 'echo %s | netcat localhost %s' % (query, STAT_PORT)
+    return json.loads(''.join(exec_cmd(command)).strip())
+
+
+def read_mounts():
+    """Get the mount points and file system types of real file systems"""
+    mounts, sources = [], set()
+    for line in read_file('/proc/self/mounts'):
+        source, mount, fstype = line.split()[:3]
+        unescape = lambda match: chr(int(match.group(1), 8))
+        mount = re.sub(REGEX_OCTAL, unescape, mount)
+
+        # Only report block devices, pools, and network shares once each
+        if DISK_MOUNTS is not None:
+            if mount not in DISK_MOUNTS:
+                continue
+        elif mount != '/':
+            if fstype in DISK_SKIP_FSTYPES:
+                continue
+            if not source.startswith('/'):
+                if fstype not in DISK_NET_FSTYPES + DISK_POOL_FSTYPES:
+                    continue
+            if source in sources:
+                continue
+        if mount not in [x for x, y in mounts]:
+            mounts.append((mount, fstype))
+            sources.add(source)
+    return mounts
+
+
+def root_disk():
+    """Get the whole disk that backs the root file system"""
+    device = None
+    for line in read_file('/proc/self/mounts'):
+        source, mount = line.split()[:2]
+        if mount == '/' and source.startswith('/dev/'):
+            device = os.path.basename(os.path.realpath(source))
+
+    # The root may be mounted from /dev/root, so fall back on its number
+    if device is None or not os.path.exists('/sys/class/block/' + device):
+        number = os.stat('/').st_dev
+        path = '/sys/dev/block/%d:%d' % (os.major(number), os.minor(number))
+        if not os.path.exists(path):
+            return None # Not backed by a block device
+        device = os.path.basename(os.path.realpath(path))
+
+    # Partitions are listed under the disk they belong to
+    path = '/sys/class/block/' + device
+    if os.path.exists(os.path.join(path, 'partition')):
+        device = os.path.basename(os.path.realpath(os.path.join(path, '..')))
+    return device
+
+
+def statvfs_mounts(mounts, timeout):
+    """Stat every mount in parallel, giving None for unresponsive mounts"""
+    results = dict()
+    def statvfs(mount):
+        results[mount] = os.statvfs(mount)
+
+    # Threads are daemonic so that a hung mount cannot block the exit
+    threads = []
+    for mount in mounts:
+        thread = threading.Thread(target = statvfs, args = (mount,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+    return dict((x, results.get(x)) for x in mounts)
+
+
+def shorten(text, width):
+    """Shorten the text to the width by eliding its middle"""
+    if len(text) <= width:
+        return text
+    head = (width - 3 + 1) / 2
+    tail = width - 3 - head
+    return text[:head] + '...' + (text[-tail:] if tail else '')
+
+
 def colorize(text, color):
     """Colorize the text only if color is enabled"""
     global opts
@@ -236,7 +343,7 @@ def display_info():
     global info_list
     max_length = max([len(key) for key, value in info_list])
     for key, value in info_list:
-        key = (key + ':').ljust(max_length + 4, ' ')
+        key = (key + ':' if key else '').ljust(max_length + 4, ' ')
         print " %s%s" % (colorize(key, TEXT_SECONDARY), value)
 
 
@@ -258,9 +365,12 @@ Warnings that can be highlighted:
  * The last login hostname if it differs from the current login hostname
  * CPU utilization if it exceeds a threshold
  * CPU load if it exceeds a threshold
+ * Pressure stall time if it exceeds a threshold
  * RAM usage if it exceeds a threshold
  * Disk usage if it exceeds a threshold
+ * Disk I/O load if it exceeds a threshold
  * Network load if it exceeds a threshold
+ * Zombie processes if there are any
 
 Author: Joe Tsai <joetsai@digital-static.net>
 """
@@ -299,6 +409,13 @@ opts_parser.add_option(
         "all values."
     ),
 )
+opts_parser.add_option(
+    '-q', '--percentiles', default = False, action = "store_true",
+    help = (
+        "Show a high percentile of CPU utilization and network traffic next "
+        "to the averages, to reveal bursts hidden by the averages."
+    ),
+)
 (opts, args) = opts_parser.parse_args()
 
 # Color is enabled if warning is enabled
@@ -419,8 +536,8 @@ except:
 
 # Get CPU utilization
 try:
-    utils = []
-    for interval in [60, 300, 900]:
+    utils, util_pcts, intervals = [], [], [60, 300, 900]
+    for interval in intervals:
         # Query for CPU utilization
         query = {
             'cpu_util': {
@@ -429,13 +546,13 @@ try:
                 'weight':   CPUUTIL_WEIGHT,
             }
         }
-        query = shell_escape(json.dumps(query))
-        command = 'echo %s | netcat localhost %s' % (query,STAT_PORT)
-        util_usage = ''.join(exec_cmd(command)).strip()
-
-        # Load the JSON data
-        data = json.loads(util_usage)
+        if opts.percentiles:
+            query['cpu_util']['percentiles'] = [CPUUTIL_PERCENTILE]
+        data = query_stat(query)
         utils.append(data['utilization'] * 100.0)
+        if opts.percentiles:
+            percentile = data['percentiles'][str(CPUUTIL_PERCENTILE)]
+            util_pcts.append(percentile * 100.0)
 
     utils_text = []
     for util in utils:
@@ -443,8 +560,37 @@ try:
         warn_check = bool(util > CPU_UTIL_WARN_LEVEL)
         color = WARNING if (opts.warn and warn_check) else NUM_PRIMARY
         utils_text.append(colorize(percent_text,color))
+
+    # Show the percentile next to each average
+    for index, util in enumerate(util_pcts):
+        percent_text = '%.2f%%' % util
+        warn_check = bool(util > CPU_UTIL_WARN_LEVEL)
+        color = WARNING if (opts.warn and warn_check) else NUM_SECONDARY
+        percent_text = colorize(percent_text, color)
+        values = utils_text[index], CPUUTIL_PERCENTILE, percent_text
+        utils_text[index] = "%s, p%s %s" % values
     values = tuple(utils_text)
     message = "%s (1 minute) - %s (5 minutes) - %s (15 minutes)" % values
+
+    # Name the top process over the shortest window that triggered a warning
+    warn_intervals = [interval for interval, util in zip(intervals, utils)
+                      if util > CPU_UTIL_WARN_LEVEL]
+    if opts.warn and warn_intervals:
+        try:
+            query = {
+                'top_procs': {
+                    'interval': warn_intervals[0],
+                    'count':    1,
+                    'sort':     'cpu',
+                }
+            }
+            process = query_stat(query)['processes'][0]
+            percent_text = colorize('%.2f%%' % (process['cpu']*100.0), WARNING)
+            name_text = colorize(process['name'], TEXT_PRIMARY)
+            values = name_text, process['pid'], percent_text
+            message += " - top is %s (%s) at %s" % values
+        except:
+            pass
     info_list.append(('CPU utilization', message))
 except:
     pass
@@ -465,6 +611,29 @@ try:
 except:
     pass
 
+# Get pressure stall information
+try:
+    stalls_text = []
+    for resource in PSI_RESOURCES:
+        # Query for time stalled with some tasks waiting on the resource
+        query = {
+            'pressure': {
+                'device':   resource,
+                'interval': PSI_INTERVAL,
+                'weight':   PSI_WEIGHT,
+            }
+        }
+        data = query_stat(query)
+        stall = data['some_average'] * 100.0
+
+        warn_check = bool(stall > PSI_WARN_LEVEL)
+        color = WARNING if (opts.warn and warn_check) else NUM_PRIMARY
+        stall_text = colorize('%.2f%%' % stall, color)
+        stalls_text.append('%s %s' % (stall_text, resource))
+    info_list.append(('Pressure stall', ', '.join(stalls_text)))
+except:
+    pass
+
 # Get memory usage
 try:
     mem_info = read_file('/proc/meminfo')
@@ -495,17 +664,35 @@ except:
 
 # Get disk usage
 try:
-    disk_usage = exec_cmd('df -B 1 /')[-1].strip()
-    label, total, used, free, others = disk_usage.split(None, 4)
-    total, used, free = int(used)+int(free), int(used), int(free)
-    percent = (float(used) / float(total)) * 100.0
-
-    warn_check = bool(percent > DISK_WARN_LEVEL)
-    color = WARNING if (opts.warn and warn_check) else NUM_PRIMARY
-    percent_text = colorize('%.2f%%' % percent, color)
-    values = percent_text, units(total, 'B'), units(used, 'B'), units(free, 'B')
-    message = "%s - %s total, %s used, %s free" % values
-    info_list.append(('Disk usage', message))
+    mounts = [mount for mount, fstype in read_mounts()]
+    mount_stats = statvfs_mounts(mounts, DISK_TIMEOUT)
+    mount_width = min(max([len(mount) for mount in mounts]), DISK_MOUNT_WIDTH)
+
+    messages = []
+    for mount in mounts:
+        stat = mount_stats[mount]
+        mount_text = shorten(mount, mount_width).ljust(mount_width)
+        mount_text = colorize(mount_text, TEXT_PRIMARY)
+        if stat is None:
+            color = WARNING if opts.warn else TEXT_PRIMARY
+            message = "%s %s" % (mount_text, colorize('unresponsive', color))
+        else:
+            used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+            free = stat.f_bavail * stat.f_frsize
+            total = used + free
+            if not total:
+                continue
+            percent = (float(used) / float(total)) * 100.0
+
+            warn_check = bool(percent > DISK_WARN_LEVEL)
+            color = WARNING if (opts.warn and warn_check) else NUM_PRIMARY
+            percent_text = colorize(('%.2f%%' % percent).rjust(6), color)
+            values = mount_text, percent_text, units(total, 'B')
+            values += units(used, 'B'), units(free, 'B')
+            message = "%s %s - %s total, %s used, %s free" % values
+        messages.append(message)
+    for index, message in enumerate(messages):
+        info_list.append(('' if index else 'Disk usage', message))
 except:
     pass
 
@@ -519,12 +706,9 @@ try:
             'weight':   NETTRAF_WEIGHT,
         }
     }
-    query = shell_escape(json.dumps(query))
-    command = 'echo %s | netcat localhost %s' % (query, STAT_PORT)
-    net_usage = ''.join(exec_cmd(command)).strip()
-
-    # Load the JSON data
-    data = json.loads(net_usage)
+    if opts.percentiles:
+        query['net_traf']['percentiles'] = [NETTRAF_PERCENTILE]
+    data = query_stat(query)
     rx_avg, tx_avg = data['rx_average'], data['tx_average']
     total = rx_avg + tx_avg
 
@@ -533,18 +717,113 @@ try:
     total_text = units(total, 'B/s', color = color)
     values = total_text,units(rx_avg, 'B/s'), units(tx_avg, 'B/s')
     message = "%s - %s down, %s up" % values
+
+    # Show the percentile of each direction
+    if opts.percentiles:
+        rx_pct = data['rx_percentiles'][str(NETTRAF_PERCENTILE)]
+        tx_pct = data['tx_percentiles'][str(NETTRAF_PERCENTILE)]
+        pcts_text = []
+        for pct in [rx_pct, tx_pct]:
+            warn_check = bool(pct > NET_WARN_LEVEL)
+            color = WARNING if (opts.warn and warn_check) else NUM_SECONDARY
+            pcts_text.append(units(pct, 'B/s', color = color))
+        values = NETTRAF_PERCENTILE, pcts_text[0], pcts_text[1]
+        message += " (p%s %s down, %s up)" % values
     info_list.append(('Network traffic', message))
 except:
     pass
 
+# Get disk I/O
+try:
+    # Query for block device statistic
+    device = DISKIO_DEVICE or root_disk()
+    assert bool(device)
+    query = {
+        'disk_io': {
+            'device':   device,
+            'interval': DISKIO_INTERVAL,
+            'weight':   DISKIO_WEIGHT,
+        }
+    }
+    data = query_stat(query)
+    rd_avg, wr_avg = data['read_average'], data['write_average']
+    total = rd_avg + wr_avg
+    percent = data['utilization'] * 100.0
+
+    warn_check = bool(total > DISKIO_WARN_LEVEL)
+    color = WARNING if (opts.warn and warn_check) else NUM_PRIMARY
+    total_text = units(total, 'B/s', color = color)
+    warn_check = bool(percent > IO_UTIL_WARN_LEVEL)
+    color = WARNING if (opts.warn and warn_check) else NUM_PRIMARY
+    percent_text = colorize('%.2f%%' % percent, color)
+    rd_text, wr_text = units(rd_avg, 'B/s'), units(wr_avg, 'B/s')
+    values = total_text, rd_text, wr_text, percent_text
+    message = "%s - %s read, %s written, %s busy" % values
+    info_list.append(('Disk I/O', message))
+except:
+    pass
+
+# Get container usage
+try:
+    # Query for control group usage
+    query = {
+        'cgroup': {
+            'device':   CGROUP_DEVICE,
+            'interval': CGROUP_INTERVAL,
+            'weight':   CGROUP_WEIGHT,
+        }
+    }
+    data = query_stat(query)
+    assert data['confined']
+
+    # CPU utilization relative to the CPUs available to the container
+    util = data['utilization'] * 100.0
+    warn_check = bool(util > CPU_UTIL_WARN_LEVEL)
+    color = WARNING if (opts.warn and warn_check) else NUM_PRIMARY
+    values = colorize('%.2f%%' % util, color), '%.2f' % data['cpu_limit']
+    info_list.append(('Container CPU', "%s of %s cores" % values))
+
+    # Memory usage relative to the container limit
+    total, used = data['memory_limit'], data['memory_average']
+    percent = (float(used)/float(total)) * 100.0
+    warn_check = bool(percent > RAM_WARN_LEVEL)
+    color = WARNING if (opts.warn and warn_check) else NUM_PRIMARY
+    percent_text = colorize('%.2f%%' % percent, color)
+    values = percent_text, units(total, 'B'), units(used, 'B')
+    info_list.append(('Container memory', "%s - %s limit, %s used" % values))
+
+    # I/O throughput of the container
+    rd_avg, wr_avg = data['read_average'], data['write_average']
+    total = rd_avg + wr_avg
+    warn_check = bool(total > DISKIO_WARN_LEVEL)
+    color = WARNING if (opts.warn and warn_check) else NUM_PRIMARY
+    total_text = units(total, 'B/s', color = color)
+    values = total_text, units(rd_avg, 'B/s'), units(wr_avg, 'B/s')
+    info_list.append(('Container I/O', "%s - %s read, %s written" % values))
+except:
+    pass
+
 # Get processes
 try:
-    user_procs = len(exec_cmd('ps U $USER h'))
-    total_procs = len(exec_cmd('ps -A h'))
+    try:
+        # Query for process counts maintained by the daemon
+        query = {'proc_count': {'user': getpass.getuser()}}
+        data = query_stat(query)
+        user_procs = data['user_processes']
+        total_procs = data['total_processes']
+        zombies = data['total_zombies']
+        assert bool(total_procs) # Daemon has finished scanning
+    except:
+        user_procs = len(exec_cmd('ps U $USER h'))
+        total_procs = len(exec_cmd('ps -A h'))
+        zombies = 0
     assert bool(total_procs or user_procs)
     assert bool(total_procs >= user_procs)
     values = colorize(user_procs,NUM_PRIMARY),colorize(total_procs,NUM_PRIMARY)
     message = "User running %s processes out of %s total" % values
+    if zombies:
+        color = WARNING if opts.warn else NUM_PRIMARY
+        message += " (%s zombies)" % colorize(zombies, color)
     info_list.append(('Processes', message))
 except:
     pass
@@ -23,12 +23,15 @@
 import re
 import os
 import sys
+import pwd
 import json
 import math
+import heapq
 import time
 import socket
 import signal
 import optparse
+import BaseHTTPServer
 import threading
 import collections
 
@@ -40,16 +43,60 @@ import collections
 # Configuration options
 HOST = '127.0.0.1' # The host to bind the socket to
 PORT = 4004        # The port to listen on
+REQUEST_TIMEOUT = 2 # Seconds to wait for a client to send its request
 SAMPLE_RATE = 1    # Samples per second
+MIN_RATE = 0.1     # Slowest samples per second in adaptive mode
+MAX_RATE = 2       # Fastest samples per second in adaptive mode
 SAMPLE_SIZE = 3600 # Samples to store per channel
+CGROUPS = 'self'   # Control groups to sample ('self' for the daemon's own)
+PROC_CHUNK = 2000  # Processes to scan per sample
+TOP_INTERVALS = [60, 300, 900] # Windows in seconds to rank processes over
+CACHE_SIZE = 64    # Computed averages to memoize per statistic
+METRICS_HOST = '127.0.0.1' # The host to bind the metrics server to
+METRICS_PORT = None # The port to serve OpenMetrics on (None to disable)
+METRICS_INTERVALS = [60, 300, 900] # Windows in seconds to export averages over
+QUANTILE_ACCURACY = 0.01 # Relative accuracy of percentiles
+QUANTILE_BLOCK = 10 # Samples per summary block (each tier is this much coarser)
+ADAPT_BACKOFF = 1.5 # Factor to lengthen the sample period by while idle
+ADAPT_CPU_LEVEL = 0.25 # CPU utilization at which sampling is fastest
+ADAPT_NET_LEVEL = 65536.0 # Network B/s at which sampling is fastest
+ADAPT_DISK_LEVEL = 0.1 # Disk utilization at which sampling is fastest
+ADAPT_PSI_LEVEL = 0.01 # Stalled time fraction at which sampling is fastest
 
 # Regex patterns
 REGEX_CPUUTIL = r'^(cpu[0-9]*)([\s0-9]*)$'
 REGEX_NETDEV = r'^\s*([^\s]+):\s*' + ((r'([0-9]+)\s+'+(r'[0-9]+\s+'*7))*2)
 REGEX_NETDEV = REGEX_NETDEV[:-1] + '*$'
 REGEX_STAT = r'cpu(\s+([0-9]+))'
+REGEX_DISKIGNORE = r'^(loop|ram)[0-9]+$'
+REGEX_CGROUPKEY = r'^([a-z_]+)\s+([0-9]+)\s*$'
+REGEX_CGROUPIO = r'([rw]bytes)=([0-9]+)'
+REGEX_PRESSURE = r'^(some|full)\s.*\stotal=([0-9]+)\s*$'
 
+# Files that container runtimes create inside their containers
+CONTAINER_MARKERS = ['/.dockerenv', '/run/.containerenv']
+
+# Resources with pressure stall information
+PRESSURE_RESOURCES = ['cpu', 'memory', 'io']
+
+# Columns of the CPU lines in /proc/stat
+CPU_MODES = [
+    'user', 'nice', 'system', 'idle', 'iowait',
+    'irq', 'softirq', 'steal', 'guest', 'guest_nice',
+]
+
+# OpenMetrics exposition format
+METRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+cpu_stat = None
 net_stat = None
+disk_stat = None
+psi_stat = None
+cgroup_stat = None
+proc_stat = None
+statistics = dict()
+metrics_cache = (None, None)
+metrics_lock = threading.Lock()
 net_socket = None
 sample_period = None
 sample_size = None
@@ -60,31 +107,131 @@ terminate = False
 ################################ Helper classes ################################
 ################################################################################
 
+class Sketch(object):
+    """Mergeable histogram giving percentiles within a relative accuracy"""
+
+    __slots__ = ('bins', 'zero', 'count', 'maximum')
+
+    # Values fall into logarithmically sized bins
+    gamma = (1.0 + QUANTILE_ACCURACY) / (1.0 - QUANTILE_ACCURACY)
+    log_gamma = math.log(gamma)
+
+    def __init__(self):
+        """Initialize an empty sketch"""
+        self.bins = dict()
+        self.zero = 0.0
+        self.count = 0.0
+        self.maximum = None
+
+    def add(self, value, weight = 1.0):
+        """Add a weighted value"""
+        if value > 0:
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+            self.bins[index] = self.bins.get(index, 0.0) + weight
+        else:
+            self.zero += weight
+        self.count += weight
+        self.maximum = max(self.maximum, value)
+
+    def merge(self, other):
+        """Add all the values of another sketch"""
+        for index, weight in other.bins.iteritems():
+            self.bins[index] = self.bins.get(index, 0.0) + weight
+        self.zero += other.zero
+        self.count += other.count
+        self.maximum = max(self.maximum, other.maximum)
+
+    def quantile(self, fraction):
+        """Get the value below which the fraction of the weight lies"""
+        if not self.count:
+            raise ValueError("No samples to compute percentiles from")
+        rank = fraction * self.count
+        total = self.zero
+        if total and total >= rank:
+            return 0.0
+        for index in sorted(self.bins):
+            total += self.bins[index]
+            if total >= rank:
+                value = 2.0 * self.gamma**index / (self.gamma + 1.0)
+                return min(value, self.maximum)
+        return self.maximum
+
+
 class Statistic(threading.Thread):
     """Generic class to handle statistics gathering"""
 
-    def __init__(self, period, size):
+    # Indexes of values that are levels rather than counters
+    gauges = ()
+
+    # Whether percentiles can be queried
+    quantiles = False
+
+    # Computed values at or above which the statistic is busy (None to ignore)
+    busy_levels = ()
+
+    # When any statistic was last busy, which keeps all of them sampling fast
+    busy_stamp = 0.0
+
+    def __init__(self, period, size, cache_size = CACHE_SIZE):
         """Initialize thread"""
         threading.Thread.__init__(self)
         self.devices = dict()
+        self.stamps = dict()
         self.ovf_exts = dict()
         self.period = period
+        self.min_period = period
+        self.max_period = period
         self.size = size
         self.sleep_event = threading.Event()
         self.lock = threading.Lock()
         self.terminate = False
         self.last_wake = None
 
+        # Memoized results are only valid for the generation they were
+        # computed in. The generation advances once all the samples of a
+        # sampling tick have been appended.
+        self.generation = 0
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Computed values are summarized in tiers of blocks, each spanning
+        # QUANTILE_BLOCK times as many samples as the tier below it. A
+        # window is covered by a bounded number of blocks from each tier.
+        # Only devices that have been queried for percentiles are tracked.
+        self.summaries = dict()
+        self.spans = [QUANTILE_BLOCK]
+        while self.spans[-1] * QUANTILE_BLOCK <= size:
+            self.spans.append(self.spans[-1] * QUANTILE_BLOCK)
+
     def run(self):
         """Run thread"""
         self.last_wake = time.time()
         while not self.terminate:
             # Obtain values from updator and append them to the buffer
+            stamp = time.time()
             for device, values in self.update():
                 device, values = self.fix_overflow(device, values)
                 with self.lock:
                     buffer = self.get_device(device)
-                    buffer.appendleft(values)
+                    buffer.appendleft(tuple(values)) # Smaller than a list
+                    self.stamps[device].appendleft(stamp)
+                    if self.summaries.has_key(device):
+                        self.summarize(device)
+            with self.lock:
+                self.generation += 1
+
+            # Sample at the fastest rate while any statistic is busy, so that
+            # statistics without busy levels keep up, and back off while idle
+            if self.min_period < self.max_period:
+                if self.busy():
+                    Statistic.busy_stamp = time.time()
+                if time.time() - self.busy_stamp <= 2*self.min_period:
+                    self.period = self.min_period
+                else:
+                    period = self.period * ADAPT_BACKOFF
+                    self.period = min(period, self.max_period)
 
             # Adjust sleep time for jitter
             sleep_time = self.period + self.last_wake - time.time()
@@ -99,6 +246,22 @@ class Statistic(threading.Thread):
         self.terminate = True
         self.sleep_event.set()
 
+    def adapt(self, min_period, max_period):
+        """Let the sample period vary between the given periods"""
+        self.min_period = min_period
+        self.max_period = max_period
+        self.period = min(max(self.period, min_period), max_period)
+
+    def busy(self):
+        """Check if the newest values of any device reach the busy levels"""
+        with self.lock:
+            for device in self.devices.keys():
+                value_arrays = self.compute(device, 1)
+                for array, level in zip(value_arrays, self.busy_levels):
+                    if level is not None and array and array[0] >= level:
+                        return True
+        return False
+
     def get_device(self, device):
         """Get the buffer for a device"""
         if self.devices.has_key(device):
@@ -106,14 +269,36 @@ class Statistic(threading.Thread):
         else:
             buffer = collections.deque(maxlen = self.size)
             self.devices[device] = buffer
+            self.stamps[device] = collections.deque(maxlen = self.size)
             return buffer
 
+    def elapsed(self, device, index):
+        """Get the seconds between a sample and the sample after it"""
+        stamps = self.stamps[device]
+        return max(stamps[index-1] - stamps[index], 1e-6)
+
+    def window(self, device, interval):
+        """Get the number of deltas that lie within the interval"""
+        stamps = self.stamps.get(device, ())
+
+        # Sample spacing may vary, so a delta is within the interval if its
+        # middle is within the interval of the newest sample. Deltas get
+        # older with their index, so bisect for the first one outside it.
+        low, high = 1, len(stamps)
+        while low < high:
+            index = (low + high) / 2
+            if stamps[0] - (stamps[index-1] + stamps[index])/2.0 > interval:
+                high = index
+            else:
+                low = index + 1
+        return low - 1
+
     def fix_overflow(self, device, values):
         """Fix numeric overflow"""
         self.ovf_exts.setdefault(device, dict())
         for index in xrange(len(values)):
             now_val = values[index]
-            if isinstance(now_val, (int, long)):
+            if isinstance(now_val, (int, long)) and index not in self.gauges:
                 self.ovf_exts[device].setdefault(index, (0,0,0))
                 offset, pre_val, bit_width = self.ovf_exts[device][index]
                 try: # Python 2.7 and above
@@ -126,27 +311,195 @@ class Statistic(threading.Thread):
                 self.ovf_exts[device][index] = (offset, now_val, bit_width)
         return device, values
 
+    def track(self, device):
+        """Start summarizing a device, beginning with its stored samples"""
+        value_arrays = self.compute(device, self.size)
+        tiers = []
+        for span in self.spans:
+            blocks = collections.deque(maxlen = self.size/span + 2)
+            tiers.append([span, [Sketch() for x in value_arrays], blocks])
+        self.summaries[device] = [0, tiers]
+
+        # Summarize from the oldest delta to the newest
+        for index in reversed(xrange(len(value_arrays[0]))):
+            values = [array[index] for array in value_arrays]
+            self.add_summary(device, values, self.elapsed(device, index+1))
+
+    def summarize(self, device):
+        """Add the newest computed values of a device to its summaries"""
+        values = [array[0] for array in self.compute(device, 1) if array]
+        if not values:
+            return # Not enough samples for a delta
+        self.add_summary(device, values, self.elapsed(device, 1))
+
+    def add_summary(self, device, values, weight):
+        """Add computed values, weighed by the time covered, to summaries"""
+        summary = self.summaries[device]
+        summary[0] += 1
+
+        # Close the open block of every tier that is now full
+        for tier in summary[1]:
+            span, block, blocks = tier
+            for sketch, value in zip(block, values):
+                sketch.add(value, weight)
+            if summary[0] % span == 0:
+                blocks.appendleft(block)
+                tier[1] = [Sketch() for x in values]
+
+    def percentiles(self, device, interval, percentiles):
+        """Compute the percentiles and maximum over a moving window"""
+        percentiles = tuple(percentiles)
+        key = ('percentiles', device, interval, percentiles)
+        return self.memoize(key, self.compute_percentiles, device, interval,
+                            percentiles)
+
+    def compute_percentiles(self, device, interval, percentiles):
+        """Compute the percentiles and maximum without caching"""
+        if not self.quantiles:
+            raise Exception("Percentiles are not supported")
+        for percentile in percentiles:
+            if not 0 <= percentile <= 100:
+                raise Exception("Invalid percentile: %s" % percentile)
+
+        with self.lock:
+            if not self.summaries.has_key(device):
+                if len(self.devices.get(device, ())) < 2:
+                    raise ValueError("No samples to compute percentiles from")
+                self.track(device)
+            count, tiers = self.summaries[device]
+
+            # Start with the open block of the finest tier. The total weight
+            # of a sketch is the time its values cover.
+            merged = [Sketch() for x in tiers[0][1]]
+            for sketch, block_sketch in zip(merged, tiers[0][1]):
+                sketch.merge(block_sketch)
+            covered = merged[0].count
+            end = count - count % tiers[0][0]
+
+            while end > 0:
+                # Find the blocks of each tier that end where the covered
+                # part of the window begins
+                candidates = []
+                for span, block, blocks in tiers:
+                    index = (count/span*span - end) / span
+                    if end % span == 0 and index < len(blocks):
+                        candidates.append((span, blocks[index]))
+                if not candidates:
+                    break # Window is longer than the stored samples
+
+                # Use the coarsest block that fits in the rest of the window,
+                # or else round to the nearest finest block in time. A window
+                # shorter than the finest block is covered by a whole block.
+                span, block = candidates[0]
+                for candidate in candidates:
+                    if covered + candidate[1][0].count <= interval:
+                        span, block = candidate
+                if covered and interval-covered < block[0].count/2.0:
+                    break
+                for sketch, block_sketch in zip(merged, block):
+                    sketch.merge(block_sketch)
+                covered += block[0].count
+                end -= span
+
+        results = []
+        for sketch in merged:
+            values = [sketch.quantile(x / 100.0) for x in percentiles]
+            results.append((values, sketch.maximum))
+        return results
+
+    def memoize(self, key, function, *args):
+        """Return the result of function, cached for the current generation"""
+        with self.lock:
+            generation = self.generation
+            entry = self.cache.pop(key, None)
+            if entry is not None and entry[0] == generation:
+                self.cache[key] = entry # Mark as most recently used
+                self.cache_hits += 1
+                return entry[1]
+            self.cache_misses += 1
+
+        result = function(*args)
+        with self.lock:
+            # Drop the result if a new sample arrived while computing it
+            if self.cache_size > 0 and generation == self.generation:
+                self.cache[key] = (generation, result)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last = False)
+        return result
+
+    def cache_info(self):
+        """Get the cache hit and miss counts"""
+        with self.lock:
+            return {
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'size': len(self.cache),
+                'max_size': self.cache_size,
+            }
+
     def average(self, device, interval, weight = 0.0):
         """Compute the moving average"""
-        length = int(round(float(interval)/self.period))
+        key = ('average', device, interval, weight)
+        averages = self.memoize(key, self.compute_average, device, interval,
+                                weight)
+        return list(averages)
+
+    def compute_average(self, device, interval, weight):
+        """Compute the moving average without caching"""
         with self.lock:
+            # Don't keep an empty buffer for devices that are never sampled
+            if not self.devices.has_key(device):
+                raise ValueError("Unknown device: %s" % device)
+            length = self.window(device, interval)
             value_arrays = self.compute(device, length)
+            size = len(value_arrays[0])
+            durations = [self.elapsed(device, x) for x in xrange(1, size+1)]
+
+        # Each value is weighed by the time it covers, and linearly by how
+        # recent the middle of that time is
+        span = sum(durations)
         averages = []
         for array in value_arrays:
-            average = 0
-            size = len(array)
+            average, total, age = 0.0, 0.0, 0.0
             offset = float(1-weight)
-            slope = float(2*(weight/(size+1)))
-            for index,value in enumerate(array):
-                kval = slope*(size-index) + offset
-                average += value*kval
-            averages.append(average/float(size))
+            slope = float(2*weight)
+            for value, duration in zip(array, durations):
+                kval = slope*(1.0 - (age + duration/2.0)/span) + offset
+                average += value*kval*duration
+                total += kval*duration
+                age += duration
+            averages.append(average/total)
         return averages
 
+    def latest(self):
+        """Get the most recent sample of every device"""
+        with self.lock:
+            return dict((x, list(y[0])) for x, y in self.devices.items() if y)
+
+    def windows(self, device):
+        """Get the moving averages of a device over the metric intervals"""
+        # Bypass the cache so scrapes don't evict the averages queried by
+        # logins
+        results = []
+        for interval in METRICS_INTERVALS:
+            try:
+                averages = self.compute_average(device, interval, 0.0)
+                results.append((str(interval), averages))
+            except (ZeroDivisionError, ValueError):
+                pass # Not enough samples to compute the average
+        return results
+
+    def metrics(self):
+        """Get the metric families as (name, type, help, samples) tuples"""
+        return []
+
 
 class NetworkStatistic(Statistic):
     """Capture the number of bytes transmitted and received"""
 
+    quantiles = True
+    busy_levels = (ADAPT_NET_LEVEL, ADAPT_NET_LEVEL)
+
     def update(self):
         """Read the proc filesystem and give updates"""
         with open('/proc/net/dev','r') as net_devs:
@@ -167,17 +520,35 @@ class NetworkStatistic(Statistic):
         for index in xrange(size):
             rx_now, tx_now = buffer[index][1], buffer[index][2]
             if index > 0:
-                rx_traf = (rx_pre-rx_now)/float(self.period)
-                tx_traf = (tx_pre-tx_now)/float(self.period)
+                elapsed = self.elapsed(device, index)
+                rx_traf = (rx_pre-rx_now)/elapsed
+                tx_traf = (tx_pre-tx_now)/elapsed
                 rx_results.append(rx_traf)
                 tx_results.append(tx_traf)
             rx_pre, tx_pre = rx_now, tx_now
         return rx_results, tx_results
 
+    def metrics(self):
+        """Get the metric families as (name, type, help, samples) tuples"""
+        # There may be many devices, so leave computing rates to the scraper
+        rx_bytes, tx_bytes = [], []
+        for device, values in sorted(self.latest().items()):
+            rx_bytes.append(((('device', device),), values[1]))
+            tx_bytes.append(((('device', device),), values[2]))
+        return [
+            ('motd_network_receive_bytes', 'counter',
+             "Bytes received by the network device.", rx_bytes),
+            ('motd_network_transmit_bytes', 'counter',
+             "Bytes transmitted by the network device.", tx_bytes),
+        ]
+
 
 class ProcessorStatistic(Statistic):
     """Capture how each CPU spends cycles"""
 
+    quantiles = True
+    busy_levels = (ADAPT_CPU_LEVEL,)
+
     def update(self):
         """Read the proc filesystem and give updates"""
         with open('/proc/stat','r') as cpu_stats:
@@ -204,6 +575,489 @@ class ProcessorStatistic(Statistic):
             pre_total, pre_idle = now_total, now_idle
         return results,
 
+    def metrics(self):
+        """Get the metric families as (name, type, help, samples) tuples"""
+        seconds, utils = [], []
+        clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+        for device, values in sorted(self.latest().items()):
+            for mode, ticks in zip(CPU_MODES, values[1:]):
+                labels = (('cpu', device), ('mode', mode))
+                seconds.append((labels, ticks / clock_ticks))
+
+        # Only average the aggregate, leaving per-CPU rates to the scraper
+        for window, (util,) in self.windows('cpu'):
+            utils.append(((('cpu', 'cpu'), ('window', window)), util))
+        return [
+            ('motd_cpu_seconds', 'counter',
+             "Time the CPU spent in each mode.", seconds),
+            ('motd_cpu_utilization_ratio', 'gauge',
+             "Average CPU utilization over the window.", utils),
+        ]
+
+
+class DiskStatistic(Statistic):
+    """Capture the amount of I/O performed by each block device"""
+
+    busy_levels = (None, None, None, None, ADAPT_DISK_LEVEL)
+
+    def __init__(self, period, size, cache_size = CACHE_SIZE):
+        """Initialize thread"""
+        Statistic.__init__(self, period, size, cache_size)
+        self.partitions = dict()
+
+    def is_partition(self, device):
+        """Check if a block device is a partition of a whole disk"""
+        if not self.partitions.has_key(device):
+            path = '/sys/class/block/%s/partition' % device.replace('/', '!')
+            self.partitions[device] = os.path.exists(path)
+        return self.partitions[device]
+
+    def update(self):
+        """Read the proc filesystem and give updates"""
+        with open('/proc/diskstats','r') as disk_stats:
+            for line in disk_stats.xreadlines():
+                fields = line.split()
+                if len(fields) < 14 or re.search(REGEX_DISKIGNORE, fields[2]):
+                    continue
+                if self.is_partition(fields[2]):
+                    continue # Only whole disks and mapped devices are kept
+
+                # Sector counts are always in units of 512 bytes. Unlike the
+                # other statistics, the raw line is not kept since there may
+                # be hundreds of devices.
+                rd_bytes, wr_bytes = int(fields[5])*512, int(fields[9])*512
+                rd_ios, wr_ios, io_ticks = fields[3], fields[7], fields[12]
+                values = [rd_bytes, wr_bytes, int(rd_ios), int(wr_ios)]
+                yield fields[2], values + [int(io_ticks)]
+
+    def compute(self, device, length):
+        """Compute the throughput, IOPS, and utilization"""
+        buffer = self.get_device(device)
+        size = min(len(buffer), length+1) # Account for extra sample for delta
+
+        # Compute "instantaneous" I/O rates for all deltas
+        results = ([], [], [], [], [])
+        for index in xrange(size):
+            now_vals = buffer[index]
+            if index > 0:
+                elapsed = self.elapsed(device, index)
+                for array, now_val, pre_val in zip(results, now_vals, pre_vals):
+                    array.append((pre_val-now_val)/elapsed)
+            pre_vals = now_vals
+
+        # Time spent doing I/O is in milliseconds
+        results[4][:] = [min(x/1000.0, 1.0) for x in results[4]]
+        return results
+
+    def metrics(self):
+        """Get the metric families as (name, type, help, samples) tuples"""
+        # There may be many devices, so leave computing rates to the scraper
+        families = [
+            ('motd_disk_read_bytes', 'counter',
+             "Bytes read from the block device.", []),
+            ('motd_disk_written_bytes', 'counter',
+             "Bytes written to the block device.", []),
+            ('motd_disk_reads_completed', 'counter',
+             "Reads completed by the block device.", []),
+            ('motd_disk_writes_completed', 'counter',
+             "Writes completed by the block device.", []),
+            ('motd_disk_io_time_seconds', 'counter',
+             "Time the block device spent doing I/O.", []),
+        ]
+        for device, values in sorted(self.latest().items()):
+            values[4] = values[4] / 1000.0 # I/O time is in milliseconds
+            for family, value in zip(families, values):
+                family[3].append(((('device', device),), value))
+        return families
+
+
+class PressureStatistic(Statistic):
+    """Capture the time tasks spend stalled waiting on each resource"""
+
+    busy_levels = (ADAPT_PSI_LEVEL, None)
+
+    def update(self):
+        """Read the proc filesystem and give updates"""
+        for resource in PRESSURE_RESOURCES:
+            try:
+                with open('/proc/pressure/' + resource, 'r') as pressure:
+                    lines = pressure.readlines()
+            except (IOError, OSError):
+                continue # Kernel is without PSI support
+
+            # Older kernels do not report full stalls for the CPU
+            totals = {'some': 0, 'full': 0}
+            for line in lines:
+                results = re.search(REGEX_PRESSURE, line)
+                if results:
+                    totals[results.group(1)] = int(results.group(2))
+            yield resource, [''.join(lines), totals['some'], totals['full']]
+
+    def compute(self, device, length):
+        """Compute the fraction of time stalled"""
+        buffer = self.get_device(device)
+        size = min(len(buffer), length+1) # Account for extra sample for delta
+
+        # Compute "instantaneous" stall fractions for all deltas
+        some_results, full_results = [], []
+        for index in xrange(size):
+            some_now, full_now = buffer[index][1], buffer[index][2]
+            if index > 0:
+                # Stall totals are in microseconds
+                elapsed = self.elapsed(device, index) * 1000000.0
+                some_stall = (some_pre-some_now)/elapsed
+                full_stall = (full_pre-full_now)/elapsed
+                some_results.append(some_stall)
+                full_results.append(full_stall)
+            some_pre, full_pre = some_now, full_now
+        return some_results, full_results
+
+    def metrics(self):
+        """Get the metric families as (name, type, help, samples) tuples"""
+        seconds, ratios = [], []
+        for device, values in sorted(self.latest().items()):
+            # Stall totals are in microseconds
+            for kind, total in zip(['some', 'full'], values[1:]):
+                labels = (('resource', device), ('kind', kind))
+                seconds.append((labels, total / 1000000.0))
+            for window, window_avgs in self.windows(device):
+                for kind, ratio in zip(['some', 'full'], window_avgs):
+                    labels = (('resource', device), ('kind', kind))
+                    ratios.append((labels + (('window', window),), ratio))
+        return [
+            ('motd_pressure_stalled_seconds', 'counter',
+             "Time tasks were stalled waiting on the resource.", seconds),
+            ('motd_pressure_stalled_ratio', 'gauge',
+             "Average fraction of time stalled over the window.", ratios),
+        ]
+
+
+class CgroupStatistic(Statistic):
+    """Capture the resources used by a set of control groups"""
+
+    gauges = (3, 4, 5)
+    busy_levels = (ADAPT_CPU_LEVEL,)
+
+    def __init__(self, period, size, cache_size = CACHE_SIZE, cgroups = None):
+        """Initialize thread"""
+        Statistic.__init__(self, period, size, cache_size)
+        self.cgroups = cgroups if cgroups is not None else CGROUPS.split(',')
+        self.confined = dict()
+
+        # The daemon's own control group is listed relative to the root of
+        # its cgroup namespace, which is where the cgroup2 mount starts
+        self.paths = dict((x, x) for x in self.cgroups)
+        if self.paths.has_key('self'):
+            self.paths['self'] = '/' # Only legacy hierarchies are in use
+            with open('/proc/self/cgroup', 'r') as cgroup_file:
+                for line in cgroup_file.xreadlines():
+                    if line.startswith('0::'):
+                        self.paths['self'] = line[3:].strip()
+
+        # Container runtimes leave marker files and tell the init process
+        self.container = any(os.path.exists(x) for x in CONTAINER_MARKERS)
+        try:
+            with open('/proc/1/environ', 'r') as environ:
+                for variable in environ.read().split('\0'):
+                    if variable.startswith('container='):
+                        self.container = True
+        except (IOError, OSError):
+            pass # Only readable by the owner of the init process
+
+        # Locate the unified hierarchy, which may be mounted on its own or
+        # next to the legacy hierarchies on hybrid systems
+        self.root = '/sys/fs/cgroup'
+        with open('/proc/self/mounts', 'r') as mounts:
+            for line in mounts.xreadlines():
+                fields = line.split()
+                if len(fields) > 2 and fields[2] == 'cgroup2':
+                    self.root = fields[1]
+                    break
+
+        # Limits to fall back on when a control group is unconstrained
+        self.host_cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+        with open('/proc/meminfo', 'r') as mem_info:
+            for line in mem_info.xreadlines():
+                if line.startswith('MemTotal:'):
+                    self.host_memory = int(line.split()[1]) * 1024
+
+    def read_cgroup(self, directory, name):
+        """Read a control file, giving None if it does not exist"""
+        try:
+            with open(os.path.join(directory, name), 'r') as cgroup_file:
+                return cgroup_file.read()
+        except (IOError, OSError):
+            return None
+
+    def cpu_limit(self, directory, cpu_max):
+        """Get the number of CPUs the control group may use"""
+        cpus = float(self.host_cpus)
+        if cpu_max and not cpu_max.startswith('max'):
+            quota, period = cpu_max.split()[:2]
+            cpus = min(cpus, float(quota) / float(period))
+        cpu_set = self.read_cgroup(directory, 'cpuset.cpus.effective')
+        if cpu_set and cpu_set.strip():
+            count = 0
+            for cpu_range in cpu_set.strip().split(','):
+                first, _, last = cpu_range.partition('-')
+                count += int(last or first) - int(first) + 1
+            cpus = min(cpus, float(count))
+        return cpus
+
+    def update(self):
+        """Read the cgroup filesystem and give updates"""
+        for cgroup in self.cgroups:
+            path = self.paths[cgroup]
+            directory = os.path.join(self.root, path.lstrip('/'))
+            cpu_stat = self.read_cgroup(directory, 'cpu.stat')
+            if cpu_stat is None:
+                continue # Control group does not exist
+
+            # A group below the root is confined only inside a container, as
+            # otherwise it is a systemd slice or service of the host. The root
+            # of a container's own cgroup namespace is confined by its limits.
+            cpu_max = self.read_cgroup(directory, 'cpu.max')
+            mem_max = self.read_cgroup(directory, 'memory.max')
+            limits = [x for x in [cpu_max, mem_max] if x]
+            limited = [x for x in limits if not x.startswith('max')]
+            if path.strip('/'):
+                self.confined[cgroup] = self.container
+            else:
+                self.confined[cgroup] = bool(limited)
+
+            cpu_usage = 0
+            for line in cpu_stat.splitlines():
+                results = re.search(REGEX_CGROUPKEY, line)
+                if results and results.group(1) == 'usage_usec':
+                    cpu_usage = int(results.group(2))
+
+            # Sum the bytes transferred over all block devices
+            io_stat = self.read_cgroup(directory, 'io.stat') or ''
+            io_bytes = {'rbytes': 0, 'wbytes': 0}
+            for key, value in re.findall(REGEX_CGROUPIO, io_stat):
+                io_bytes[key] += int(value)
+
+            mem_used = self.read_cgroup(directory, 'memory.current')
+            mem_used = int(mem_used) if mem_used else 0
+            if mem_max and not mem_max.startswith('max'):
+                mem_limit = min(int(mem_max), self.host_memory)
+            else:
+                mem_limit = self.host_memory
+
+            values = [cpu_usage, io_bytes['rbytes'], io_bytes['wbytes']]
+            values += [self.cpu_limit(directory, cpu_max), mem_used, mem_limit]
+            yield cgroup, values
+
+    def compute(self, device, length):
+        """Compute the utilization, throughput, and memory usage"""
+        buffer = self.get_device(device)
+        size = min(len(buffer), length+1) # Account for extra sample for delta
+
+        # Compute "instantaneous" usage for all deltas
+        results = ([], [], [], [], [], [])
+        for index in xrange(size):
+            now_vals = buffer[index]
+            if index > 0:
+                # CPU usage is in microseconds
+                elapsed = self.elapsed(device, index)
+                cpu_util = (pre_vals[0]-now_vals[0])/(elapsed*1000000.0)
+                results[0].append(cpu_util / pre_vals[3])
+                results[1].append((pre_vals[1]-now_vals[1])/elapsed)
+                results[2].append((pre_vals[2]-now_vals[2])/elapsed)
+                for array, pre_val in zip(results[3:], pre_vals[3:]):
+                    array.append(pre_val)
+            pre_vals = now_vals
+        return results
+
+    def metrics(self):
+        """Get the metric families as (name, type, help, samples) tuples"""
+        families = [
+            ('motd_cgroup_cpu_usage_seconds', 'counter',
+             "CPU time used by the control group.", []),
+            ('motd_cgroup_read_bytes', 'counter',
+             "Bytes read by the control group.", []),
+            ('motd_cgroup_written_bytes', 'counter',
+             "Bytes written by the control group.", []),
+            ('motd_cgroup_cpu_limit_cores', 'gauge',
+             "CPUs the control group may use.", []),
+            ('motd_cgroup_memory_bytes', 'gauge',
+             "Memory used by the control group.", []),
+            ('motd_cgroup_memory_limit_bytes', 'gauge',
+             "Memory the control group may use.", []),
+        ]
+        utils = []
+        for device, values in sorted(self.latest().items()):
+            values[0] = values[0] / 1000000.0 # CPU usage is in microseconds
+            for family, value in zip(families, values):
+                family[3].append(((('cgroup', device),), value))
+            for window, window_avgs in self.windows(device):
+                labels = (('cgroup', device), ('window', window))
+                utils.append((labels, window_avgs[0]))
+        return families + [
+            ('motd_cgroup_cpu_utilization_ratio', 'gauge',
+             "Average utilization of the CPU limit over the window.", utils),
+        ]
+
+
+class ProcessStatistic(Statistic):
+    """Track the usage of each process and the processes of each user"""
+
+    def __init__(self, period, size, cache_size = CACHE_SIZE,
+                 chunk = PROC_CHUNK):
+        """Initialize thread"""
+        Statistic.__init__(self, period, size, cache_size)
+        self.chunk = chunk
+        self.pending = []
+        self.seen = set()
+        self.tally = dict()
+        self.counts = dict()
+        self.processes = dict()
+        self.clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def scan(self, pid):
+        """Read the status of a process, giving None if it has exited"""
+        try:
+            with open('/proc/%s/stat' % pid, 'r') as proc_stat:
+                line = proc_stat.read()
+                uid = os.fstat(proc_stat.fileno()).st_uid
+        except (IOError, OSError):
+            return None
+
+        # The command name may contain spaces and parentheses
+        name_end = line.rfind(')')
+        name = line[line.find('(')+1:name_end]
+        fields = line[name_end+2:].split()
+        cpu_ticks = int(fields[11]) + int(fields[12]) # User and system time
+        start_time, rss = fields[19], int(fields[21]) * self.page_size
+
+        # Count the process towards its owner
+        tally = self.tally.setdefault(uid, [0, 0, 0])
+        tally[0] += 1
+        tally[1] += int(fields[17])
+        tally[2] += int(fields[0] == 'Z')
+        return (int(pid), start_time), name, cpu_ticks, rss
+
+    def update(self):
+        """Scan the next chunk of processes and update their averages"""
+        if not self.pending:
+            self.seen = set()
+            self.tally = dict()
+            self.pending = [x for x in os.listdir('/proc') if x.isdigit()]
+
+        # Spread the scan over several samples to bound the cost of each
+        chunk = self.pending[-self.chunk:]
+        del self.pending[-self.chunk:]
+        results = [x for x in (self.scan(pid) for pid in chunk) if x]
+        now = time.time()
+
+        # Each window is an exponentially decaying average of the process
+        # usage, which accounts for the uneven time between visits
+        with self.lock:
+            for key, name, cpu_ticks, rss in results:
+                self.seen.add(key)
+                record = self.processes.get(key)
+                if record is None:
+                    cpu_avgs = [None] * len(TOP_INTERVALS)
+                    rss_avgs = [float(rss)] * len(TOP_INTERVALS)
+                    record = [name, cpu_ticks, now, cpu_avgs, rss_avgs]
+                    self.processes[key] = record
+                    continue
+
+                pre_ticks, pre_time, cpu_avgs, rss_avgs = record[1:]
+                elapsed = now - pre_time
+                if elapsed <= 0:
+                    continue
+                cpu_util = (cpu_ticks-pre_ticks) / self.clock_ticks / elapsed
+                for index, interval in enumerate(TOP_INTERVALS):
+                    decay = math.exp(-elapsed / interval)
+                    if cpu_avgs[index] is None:
+                        cpu_avgs[index] = cpu_util
+                    else:
+                        cpu_avgs[index] *= decay
+                        cpu_avgs[index] += cpu_util * (1-decay)
+                    rss_avgs[index] *= decay
+                    rss_avgs[index] += rss * (1-decay)
+                record[:3] = name, cpu_ticks, now
+
+            # Forget processes that were not seen during the full pass and
+            # publish the process counts of the pass
+            if not self.pending:
+                for key in self.processes.keys():
+                    if key not in self.seen:
+                        del self.processes[key]
+                self.counts = self.tally
+        return []
+
+    def count(self, uid = None):
+        """Count the processes, threads, and zombies of a user or of all"""
+        with self.lock:
+            if uid is not None:
+                return list(self.counts.get(uid, [0, 0, 0]))
+            return [sum(x) for x in zip([0, 0, 0], *self.counts.values())]
+
+    def metrics(self):
+        """Get the metric families as (name, type, help, samples) tuples"""
+        with self.lock:
+            counts = sorted(self.counts.items())
+        families = [
+            ('motd_processes', 'gauge', "Processes owned by the user.", []),
+            ('motd_threads', 'gauge', "Threads owned by the user.", []),
+            ('motd_zombie_processes', 'gauge',
+             "Zombie processes owned by the user.", []),
+        ]
+        for uid, values in counts:
+            for family, value in zip(families, values):
+                family[3].append(((('uid', str(uid)),), value))
+        return families
+
+    def top(self, interval, count, sort = 'cpu'):
+        """Get the processes with the highest average usage"""
+        key = ('top', interval, count, sort)
+        return self.memoize(key, self.compute_top, interval, count, sort)
+
+    def compute_top(self, interval, count, sort):
+        """Get the processes with the highest average usage without caching"""
+        if interval not in TOP_INTERVALS:
+            raise Exception("Unsupported interval: %s" % interval)
+        if sort not in ['cpu', 'rss']:
+            raise Exception("Unknown sort key: %s" % sort)
+        index = TOP_INTERVALS.index(interval)
+        column = 3 if sort == 'cpu' else 4
+
+        with self.lock:
+            processes = heapq.nlargest(count, self.processes.items(),
+                key = lambda (key, record): record[column][index] or 0.0)
+            return [{
+                'pid': key[0],
+                'name': record[0],
+                'cpu': record[3][index] or 0.0,
+                'rss': record[4][index],
+            } for key, record in processes]
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the statistics to metric scrapers"""
+
+    # The server handles one connection at a time, so drop idle clients
+    timeout = REQUEST_TIMEOUT
+
+    def do_GET(self):
+        """Handle a scrape request"""
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = render_metrics()
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_TYPE)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        """Do not log every scrape"""
+        pass
+
 
 ################################################################################
 ############################### Helper functions ###############################
@@ -215,6 +1069,37 @@ def interrupt_handler(sig_num, frame):
     terminate = True
 
 
+def render_metrics():
+    """Render all statistics in the OpenMetrics text format"""
+    global metrics_cache, cpu_stat
+
+    # Rebuild the payload at most once per sampling tick of the CPU, rather
+    # than whenever any of the statistics ticks
+    key = cpu_stat.generation
+    with metrics_lock:
+        if metrics_cache[0] == key:
+            return metrics_cache[1]
+
+    escape = lambda x: x.replace('\\', r'\\').replace('"', r'\"')
+    lines = []
+    for name, stat in sorted(statistics.items()):
+        for family, family_type, family_help, samples in stat.metrics():
+            lines.append('# TYPE %s %s' % (family, family_type))
+            lines.append('# HELP %s %s' % (family, family_help))
+            suffix = '_total' if family_type == 'counter' else ''
+            for labels, value in samples:
+                labels = ['%s="%s"' % (x, escape(y)) for x, y in labels]
+                value = repr(value) if isinstance(value, float) else str(value)
+                values = family, suffix, ','.join(labels), value
+                lines.append('%s%s{%s} %s' % values)
+    lines.append('# EOF')
+    payload = '\n'.join(lines) + '\n'
+
+    with metrics_lock:
+        metrics_cache = (key, payload)
+    return payload
+
+
 def network_handler():
     """Handle all new network requests"""
     global net_socket
@@ -224,8 +1109,10 @@ def network_handler():
         conn,addr = net_socket.accept()
         conn.settimeout(1)
         try:
-            # Read data from client
-            while not terminate:
+            # Read data from client, giving up on idle clients so they
+            # don't block the requests queued behind them
+            deadline = time.time() + REQUEST_TIMEOUT
+            while not terminate and time.time() < deadline:
                 try:
                     data = conn.recv(1024)
                     if not data:
@@ -248,7 +1135,8 @@ def network_handler():
 
 def process_request(data):
     """Process a client's request"""
-    global cpu_stat, net_stat
+    global cpu_stat, net_stat, disk_stat, psi_stat, cgroup_stat, proc_stat
+    global statistics
 
     # Try and parse the arguments
     try:
@@ -261,8 +1149,13 @@ def process_request(data):
         # Comamnd is debug
         if data.has_key('debug'):
             debug = data['debug']
-            if debug in ['cpu_util', 'net_traf']:
-                stat = cpu_stat if debug == 'cpu_util' else net_stat
+            if debug == 'cache':
+                data = dict()
+                for name, stat in statistics.items():
+                    data[name] = stat.cache_info()
+                return json.dumps(data)
+            elif statistics.has_key(debug):
+                stat = statistics[debug]
                 with stat.lock:
                     data = dict()
                     for device, buffer in stat.devices.items():
@@ -279,7 +1172,68 @@ def process_request(data):
             weight = kwargs.get('weight', 0.0)    # Average weight constant
 
             rx_avg, tx_avg = net_stat.average(device, interval, weight = weight)
-            return json.dumps({'rx_average': rx_avg, 'tx_average': tx_avg})
+            results = {'rx_average': rx_avg, 'tx_average': tx_avg}
+
+            # Percentiles and maximum of the bandwidth, e.g. [95, 99]
+            if kwargs.has_key('percentiles'):
+                percentiles = kwargs['percentiles']
+                rx_pcts, tx_pcts = net_stat.percentiles(device, interval,
+                                                        percentiles)
+                results['rx_percentiles'] = dict(zip(percentiles, rx_pcts[0]))
+                results['tx_percentiles'] = dict(zip(percentiles, tx_pcts[0]))
+                results['rx_maximum'] = rx_pcts[1]
+                results['tx_maximum'] = tx_pcts[1]
+            return json.dumps(results)
+
+        # Command is for block device I/O
+        if data.has_key('disk_io'):
+            kwargs = data['disk_io']
+            device = kwargs.get('device', 'sda')  # The block device
+            interval = kwargs.get('interval', 10) # Time length in seconds
+            weight = kwargs.get('weight', 0.0)    # Average weight constant
+
+            averages = disk_stat.average(device, interval, weight = weight)
+            rd_avg, wr_avg, rd_iops, wr_iops, utilization = averages
+            return json.dumps({
+                'read_average': rd_avg,
+                'write_average': wr_avg,
+                'read_iops': rd_iops,
+                'write_iops': wr_iops,
+                'utilization': utilization,
+            })
+
+        # Command is for pressure stall information
+        if data.has_key('pressure'):
+            kwargs = data['pressure']
+            device = kwargs.get('device', 'cpu')  # The stalled resource
+            interval = kwargs.get('interval', 10) # Time length in seconds
+            weight = kwargs.get('weight', 0.0)    # Average weight constant
+
+            averages = psi_stat.average(device, interval, weight = weight)
+            some_avg, full_avg = averages
+            return json.dumps({
+                'some_average': some_avg,
+                'full_average': full_avg,
+            })
+
+        # Command is for control group usage
+        if data.has_key('cgroup'):
+            kwargs = data['cgroup']
+            device = kwargs.get('device', 'self') # The control group
+            interval = kwargs.get('interval', 10) # Time length in seconds
+            weight = kwargs.get('weight', 0.0)    # Average weight constant
+
+            averages = cgroup_stat.average(device, interval, weight = weight)
+            cpu_util, rd_avg, wr_avg, cpu_limit, mem_avg, mem_limit = averages
+            return json.dumps({
+                'confined': cgroup_stat.confined.get(device, False),
+                'utilization': cpu_util,
+                'cpu_limit': cpu_limit,
+                'memory_average': mem_avg,
+                'memory_limit': mem_limit,
+                'read_average': rd_avg,
+                'write_average': wr_avg,
+            })
 
         # Command is for CPU utilization
         if data.has_key('cpu_util'):
@@ -291,7 +1245,44 @@ def process_request(data):
                 device = 'cpu'
 
             utilization, = cpu_stat.average(device, interval, weight = weight)
-            return json.dumps({'utilization': utilization})
+            results = {'utilization': utilization}
+
+            # Percentiles and maximum of the utilization, e.g. [95, 99]
+            if kwargs.has_key('percentiles'):
+                percentiles = kwargs['percentiles']
+                (pcts, maximum), = cpu_stat.percentiles(device, interval,
+                                                        percentiles)
+                results['percentiles'] = dict(zip(percentiles, pcts))
+                results['maximum'] = maximum
+            return json.dumps(results)
+
+        # Command is for the processes with the highest usage
+        if data.has_key('top_procs'):
+            kwargs = data['top_procs']
+            interval = kwargs.get('interval', 60) # Time length in seconds
+            count = kwargs.get('count', 5)        # Number of processes
+            sort = kwargs.get('sort', 'cpu')      # Either 'cpu' or 'rss'
+
+            processes = proc_stat.top(interval, count, sort = sort)
+            return json.dumps({'processes': processes})
+
+        # Command is for the number of processes
+        if data.has_key('proc_count'):
+            kwargs = data['proc_count']
+            user = kwargs.get('user', None) # The user name or ID
+
+            results = dict()
+            if user is not None:
+                uid = user if isinstance(user, int) else pwd.getpwnam(user)[2]
+                procs, threads, zombies = proc_stat.count(uid)
+                results['user_processes'] = procs
+                results['user_threads'] = threads
+                results['user_zombies'] = zombies
+            procs, threads, zombies = proc_stat.count()
+            results['total_processes'] = procs
+            results['total_threads'] = threads
+            results['total_zombies'] = zombies
+            return json.dumps(results)
 
     except Exception, ex:
         return json.dumps({'error': str(ex)})
@@ -311,14 +1302,57 @@ opts_parser.add_option(
     '-r', '--sample_rate', default = SAMPLE_RATE, type = 'float',
     help = "Rate to log network statistics in samples per second [%default].",
 )
+opts_parser.add_option(
+    '-a', '--adaptive', default = False, action = 'store_true',
+    help = (
+        "Vary the sample rate between the minimum and maximum rates, backing "
+        "off while idle and sampling fastest while busy. The sample rate is "
+        "the initial rate."
+    ),
+)
+opts_parser.add_option(
+    '--min_rate', default = MIN_RATE, type = 'float',
+    help = "Slowest rate in samples per second in adaptive mode [%default].",
+)
+opts_parser.add_option(
+    '--max_rate', default = MAX_RATE, type = 'float',
+    help = "Fastest rate in samples per second in adaptive mode [%default].",
+)
 opts_parser.add_option(
     '-s', '--sample_size', default = SAMPLE_SIZE, type = 'int',
     help = "The amount of samples to store before rolling [%default].",
 )
+opts_parser.add_option(
+    '-H', '--host', default = HOST,
+    help = "The host address to bind the query socket to [%default].",
+)
 opts_parser.add_option(
     '-p', '--port', default = PORT, type = 'int',
     help = "The port to report statistics on [%default].",
 )
+opts_parser.add_option(
+    '--metrics_host', default = METRICS_HOST,
+    help = "The host address to bind the metrics server to [%default].",
+)
+opts_parser.add_option(
+    '-m', '--metrics_port', default = METRICS_PORT, type = 'int',
+    help = "The port to serve OpenMetrics on, if any [%default].",
+)
+opts_parser.add_option(
+    '-g', '--cgroups', default = CGROUPS,
+    help = (
+        "Comma separated control groups to sample, relative to the cgroup2 "
+        "mount, where 'self' is the daemon's own control group [%default]."
+    ),
+)
+opts_parser.add_option(
+    '-n', '--proc_chunk', default = PROC_CHUNK, type = 'int',
+    help = "The amount of processes to scan per sample [%default].",
+)
+opts_parser.add_option(
+    '-c', '--cache_size', default = CACHE_SIZE, type = 'int',
+    help = "The amount of computed averages to cache per statistic [%default].",
+)
 (opts, args) = opts_parser.parse_args()
 
 if opts.sample_size <= 0:
@@ -329,6 +1363,18 @@ if opts.sample_rate <= 0:
     print "Sample rate must be a positive value"
     sys.exit(1)
 
+if opts.adaptive and not (0 < opts.min_rate <= opts.max_rate):
+    print "Sample rates must be positive with the minimum below the maximum"
+    sys.exit(1)
+
+if opts.proc_chunk <= 0:
+    print "Process chunk must be a positive value"
+    sys.exit(1)
+
+if opts.cache_size < 0:
+    print "Cache size must be a non-negative value"
+    sys.exit(1)
+
 sample_period = 1.0 / opts.sample_rate
 sample_size = opts.sample_size
 
@@ -343,21 +1389,47 @@ signal.signal(signal.SIGTERM, interrupt_handler)
 
 # Setup the network socket
 net_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-net_socket.bind((HOST, opts.port))
+net_socket.bind((opts.host, opts.port))
 net_socket.listen(5)
 net_socket.settimeout(1)
 
-# Start the network data gatherer
-cpu_stat = ProcessorStatistic(sample_period,sample_size)
-net_stat = NetworkStatistic(sample_period,sample_size)
-cpu_stat.start()
-net_stat.start()
+# Start the statistic data gatherers
+cpu_stat = ProcessorStatistic(sample_period,sample_size,opts.cache_size)
+net_stat = NetworkStatistic(sample_period,sample_size,opts.cache_size)
+disk_stat = DiskStatistic(sample_period,sample_size,opts.cache_size)
+psi_stat = PressureStatistic(sample_period,sample_size,opts.cache_size)
+cgroup_stat = CgroupStatistic(sample_period,sample_size,opts.cache_size,
+                              opts.cgroups.split(','))
+proc_stat = ProcessStatistic(sample_period,sample_size,opts.cache_size,
+                             opts.proc_chunk)
+statistics['cpu_util'] = cpu_stat
+statistics['net_traf'] = net_stat
+statistics['disk_io'] = disk_stat
+statistics['pressure'] = psi_stat
+statistics['cgroup'] = cgroup_stat
+statistics['top_procs'] = proc_stat
+for stat in statistics.values():
+    if opts.adaptive:
+        stat.adapt(1.0 / opts.max_rate, 1.0 / opts.min_rate)
+    stat.start()
+
+# Start the metrics exposition server
+metrics_server = None
+if opts.metrics_port:
+    metrics_address = (opts.metrics_host, opts.metrics_port)
+    metrics_server = BaseHTTPServer.HTTPServer(metrics_address, MetricsHandler)
+    metrics_thread = threading.Thread(target = metrics_server.serve_forever)
+    metrics_thread.daemon = True
+    metrics_thread.start()
 
 # The main event loop
 try:
     while not terminate:
         network_handler()
 finally:
-    cpu_stat.stop()
-    net_stat.stop()
+    for stat in statistics.values():
+        stat.stop()
+    if metrics_server:
+        metrics_server.shutdown()
+        metrics_server.server_close()
     net_socket.close()